@@ -1,13 +1,14 @@
+import asyncio
+import html
 import logging
-import random
+import re
 import sqlite3
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from math import ceil
-from threading import Lock
 from urllib.parse import parse_qs, urlparse
 
+import orjson
 import pandas as pd
 # import requests
 from bs4 import BeautifulSoup
@@ -23,6 +24,17 @@ logging.basicConfig(
 
 # Database setup
 DB_PATH = "nike_tracker.db"
+
+# Text timestamps from earlier runs are read as IST (UTC+05:30), the zone
+# price_tracker displays; this SQLite modifier shifts them to UTC
+LEGACY_TIMESTAMP_TO_UTC = "-330 minutes"
+
+# Maximum concurrent API page requests per category
+MAX_PAGE_WORKERS = 8
+
+# Attempts per API page while the server is rate limiting
+MAX_RETRIES = 5
+
 URLS = [
     "https://www.nike.com/in/w/mens-shoes-nik1zy7ok",
     "https://www.nike.com/in/w/mens-clothing-6ymx6znik1",
@@ -36,9 +48,17 @@ URLS = [
 ]
 
 
+def get_connection():
+    """Open a SQLite connection tuned for bulk writes"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
 def init_db():
     """Initialize SQLite database with required tables"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     c = conn.cursor()
 
     # Create products table
@@ -63,12 +83,30 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             product_code TEXT,
             price REAL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
             FOREIGN KEY (product_code) REFERENCES products(product_code)
         )
     """
     )
 
+    # Convert timestamps written as text by earlier runs to unix seconds
+    c.execute(
+        """
+        UPDATE price_history
+        SET timestamp = CAST(strftime('%s', timestamp, ?) AS INTEGER)
+        WHERE typeof(timestamp) = 'text'
+    """,
+        (LEGACY_TIMESTAMP_TO_UTC,),
+    )
+
+    # Index per-product history lookups
+    c.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_ph_pc_ts
+        ON price_history (product_code, timestamp)
+    """
+    )
+
     conn.commit()
     conn.close()
     logging.info("Database initialized successfully")
@@ -80,10 +118,10 @@ def update_database(df):
         logging.warning("No data to update")
         return
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    # timestamp=(datetime.now() + timedelta(hours=13)).strftime("%Y-%m-%d %H:%M:%S") # for testing
+    timestamp = int(time.time())
+    # timestamp = int(time.time()) + 13 * 60 * 60  # for testing
 
     try:
         columns_mapping = {
@@ -96,54 +134,55 @@ def update_database(df):
         }
 
         # Prepare data for products table with explicit column selection
-        products_data = df[list(columns_mapping.keys())].copy()
-        products_data.columns = list(columns_mapping.values())
+        products_view = df.rename(columns=columns_mapping, copy=False)[
+            list(columns_mapping.values())
+        ]
 
         # Debug logging
-        logging.info(f"Columns in products_data: {products_data.columns.tolist()}")
+        logging.info(f"Columns in products_view: {products_view.columns.tolist()}")
 
-        # Update products table (manual upsert)
-        for idx, row in products_data.iterrows():
-            # Debug logging for first row
-            if idx == 0:
-                logging.info(f"Sample row data: {dict(row)}")
-
-            cursor.execute(
-                """
-                INSERT OR REPLACE INTO products 
-                (product_code, title, subtitle, category, image_url, url)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """,
-                (
-                    row["product_code"],
-                    row["title"],
-                    row["subtitle"],
-                    row["category"],
-                    row["image_url"],
-                    row["url"],
-                ),
+        # Build plain tuples once so each statement is prepared a single time
+        price_rows = [
+            (product_code, price, timestamp)
+            for product_code, price in zip(
+                df["productCode"].tolist(), df["prices.currentPrice"].tolist()
             )
+        ]
 
-        # Prepare and insert price history
-        for _, row in df.iterrows():
-            cursor.execute(
-                """
-                INSERT INTO price_history (product_code, price, timestamp)
-                VALUES (?, ?, ?)
-            """,
-                (row["productCode"], row["prices.currentPrice"], timestamp),
-            )
+        cursor.execute("BEGIN")
+
+        # Update products table (manual upsert)
+        cursor.executemany(
+            """
+            INSERT INTO products
+            (product_code, title, subtitle, category, image_url, url)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(product_code) DO UPDATE SET
+                title = excluded.title,
+                subtitle = excluded.subtitle,
+                category = excluded.category,
+                image_url = excluded.image_url,
+                url = excluded.url
+        """,
+            products_view.itertuples(index=False, name=None),
+        )
+
+        # Insert price history
+        cursor.executemany(
+            """
+            INSERT INTO price_history (product_code, price, timestamp)
+            VALUES (?, ?, ?)
+        """,
+            price_rows,
+        )
 
         conn.commit()
         logging.info(
-            f"Updated {len(products_data)} products and added {len(df)} price entries"
+            f"Updated {len(products_view)} products and added {len(price_rows)} price entries"
         )
 
     except Exception as e:
         logging.error(f"Error updating database: {str(e)}")
-        # Additional error context
-        if "row" in locals():
-            logging.error(f"Failed row data: {dict(row)}")
         conn.rollback()
 
     finally:
@@ -170,148 +209,238 @@ def get_headers(type="html"):
         }
 
 
-# Thread-safe progress bar update
-progress_lock = Lock()
+DEEPLINK_META_RE = re.compile(
+    rb'name="branch:deeplink:\$deeplink_path"\s+content="([^"]+)"'
+)
 
 
-def extract_concept_ids(session, url):
+async def extract_concept_ids(session, url):
     """Extract concept IDs from Nike category page"""
     try:
-        with progress_lock:
-            print(f"\nFetching HTML from: {url}")
-        response = session.get(url, headers=get_headers("html"))
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        meta_tag = soup.find("meta", {"name": "branch:deeplink:$deeplink_path"})
-        if not meta_tag or not meta_tag.get("content"):
-            with progress_lock:
-                print(f"No concept IDs found for {url}")
+        print(f"\nFetching HTML from: {url}")
+        response = await session.get(url, headers=get_headers("html"))
+
+        # Look for the meta tag directly before falling back to a full parse
+        match = DEEPLINK_META_RE.search(response.content)
+        if match:
+            deeplink_path = html.unescape(match.group(1).decode())
+        else:
+            soup = BeautifulSoup(response.text, "html.parser")
+            meta_tag = soup.find("meta", {"name": "branch:deeplink:$deeplink_path"})
+            deeplink_path = meta_tag.get("content") if meta_tag else None
+
+        if not deeplink_path:
+            print(f"No concept IDs found for {url}")
             return None
 
-        deeplink_path = meta_tag["content"]
         query_params = parse_qs(urlparse(deeplink_path).query)
 
         if "conceptid" not in query_params:
-            with progress_lock:
-                print(f"No concept IDs in meta tag for {url}")
+            print(f"No concept IDs in meta tag for {url}")
             return None
 
         return query_params["conceptid"][0]
 
     except Exception as e:
-        with progress_lock:
-            print(f"Error extracting concept IDs for {url}: {str(e)}")
+        print(f"Error extracting concept IDs for {url}: {str(e)}")
         return None
 
 
 def parse_response(response_json):
     """Parse API response and extract product information"""
     try:
-        products_df = pd.json_normalize(
-            [
-                i.get("products")[0]
-                for i in response_json["productGroupings"]
-                if i.get("products")
-            ]
-        )[
-            [
-                "productCode",
-                "badgeLabel",
-                "copy.title",
-                "copy.subTitle",
-                "prices.currency",
-                "prices.currentPrice",
-                "pdpUrl.url",
-                "colorwayImages.portraitURL",
-            ]
-        ]
+        products = []
+        for grouping in response_json["productGroupings"]:
+            if not grouping.get("products"):
+                continue
+            product = grouping["products"][0]
+
+            # Skip only products that cannot be tracked; missing or null
+            # nested fields become None, as json_normalize left them NaN
+            if not product.get("productCode"):
+                continue
+            copy = product.get("copy") or {}
+            prices = product.get("prices") or {}
+            pdp_url = product.get("pdpUrl") or {}
+            colorway_images = product.get("colorwayImages") or {}
+
+            products.append(
+                {
+                    "productCode": product["productCode"],
+                    "badgeLabel": product.get("badgeLabel"),
+                    "copy.title": copy.get("title"),
+                    "copy.subTitle": copy.get("subTitle"),
+                    "prices.currency": prices.get("currency"),
+                    "prices.currentPrice": prices.get("currentPrice"),
+                    "pdpUrl.url": pdp_url.get("url"),
+                    "colorwayImages.portraitURL": colorway_images.get("portraitURL"),
+                }
+            )
 
         # Add random price variation of ±10% (only to demonstrate how pricing graph would look like when actual prices change)
-        # products_df["prices.currentPrice"] = products_df["prices.currentPrice"].apply(
-        #     lambda x: x + (random.uniform(-0.1, 0.1) * x)
-        # )
+        # for product in products:
+        #     price = product["prices.currentPrice"]
+        #     product["prices.currentPrice"] = price + (random.uniform(-0.1, 0.1) * price)
 
-        return [products_df]
+        return products
     except Exception as e:
-        with progress_lock:
-            print(f"Error parsing response: {str(e)}")
+        print(f"Error parsing response: {str(e)}")
         return []
 
 
-def fetch_nike_products(session, url, category):
-    """Fetch all products for a given category URL"""
+class AdaptiveLimiter:
+    """Delay requests only while the server is rate limiting"""
+
+    def __init__(self, base_delay=0.0, max_delay=30.0, decay_after=10):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.decay_after = decay_after
+        self.successes = 0
+        self.last_backoff = 0.0
+        # Monotonic time before which no request is sent (from Retry-After)
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        """Honour any pending Retry-After, then space requests by the delay"""
+        pause = self.resume_at - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        if not self.base_delay:
+            return
+        async with self.lock:
+            if self.base_delay:
+                await asyncio.sleep(self.base_delay)
+
+    def backoff(self, response):
+        """Double the delay and pause once for any Retry-After"""
+        self.successes = 0
+        # Responses already in flight when the server started limiting count as
+        # one event, so a burst of 429s doubles the delay only once
+        now = time.monotonic()
+        if now - self.last_backoff >= self.base_delay:
+            self.base_delay = min(max(self.base_delay * 2, 1.0), self.max_delay)
+            self.last_backoff = now
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            self.resume_at = max(self.resume_at, now + float(retry_after))
+
+    def success(self):
+        """Halve the delay after decay_after consecutive successes"""
+        if not self.base_delay:
+            return
+        self.successes += 1
+        if self.successes < self.decay_after:
+            return
+        self.successes = 0
+        self.base_delay = self.base_delay / 2 if self.base_delay >= 0.1 else 0.0
+
+
+async def fetch_page(session, rate_limiter, url, headers):
+    """Fetch a single API page, backing off while rate limited"""
+    for _ in range(MAX_RETRIES):
+        await rate_limiter.wait()
+        response = await session.get(url, headers=headers)
+        if response.status_code not in (429, 503):
+            rate_limiter.success()
+            break
+        rate_limiter.backoff(response)
+    else:
+        # Still rate limited after every retry; fail loudly instead of parsing
+        # the error body
+        response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+async def fetch_nike_products(session, rate_limiter, concept_ids, path, category):
+    """Fetch all products for a given category"""
     try:
         headers = get_headers("api")
 
         # Get initial response
-        initial_response = session.get(url, headers=headers)
-        data = initial_response.json()
+        url = construct_api_url(concept_ids, path)
+        data = await fetch_page(session, rate_limiter, url, headers)
 
         total_products = data["pages"]["totalResources"]
-        count = 100  # Maximum allowed count
-        total_pages = ceil(total_products / count) - 1
+        total_pages = ceil(total_products / PAGE_SIZE) - 1
 
         all_products = []
-        next_page = data["pages"].get("next")
 
         # Parse and add initial products
         initial_products = parse_response(data)
         all_products.extend(initial_products)
 
+        # Remaining pages are known up front, so request them concurrently
+        page_urls = [
+            construct_api_url(concept_ids, path, anchor)
+            for anchor in range(PAGE_SIZE, total_products, PAGE_SIZE)
+        ]
+
         # Create progress bar for pagination
         with tqdm(
             total=total_pages,
             desc=f"Fetching {category}",
             leave=False,
-            initial=1,
             position=0,  # Ensure proper positioning in parallel execution
         ) as pbar:
-            while next_page:
-                time.sleep(random.uniform(1, 3))  # Keep rate limiting
-
-                next_url = f"https://api.nike.com{next_page}"
-
-                response = session.get(next_url, headers=headers)
-                data = response.json()
+            semaphore = asyncio.Semaphore(MAX_PAGE_WORKERS)
+
+            async def fetch_next_page(page_url):
+                async with semaphore:
+                    data = await fetch_page(
+                        session, rate_limiter, page_url, headers
+                    )
+                pbar.update(1)
+                return data
+
+            tasks = [
+                asyncio.create_task(fetch_next_page(page_url)) for page_url in page_urls
+            ]
+            try:
+                # gather returns results in anchor order
+                pages = await asyncio.gather(*tasks)
+            finally:
+                # If one page failed, stop the rest before the progress bar closes
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
 
+            for data in pages:
                 new_products = parse_response(data)
                 all_products.extend(new_products)
 
-                next_page = data["pages"].get("next")
-
-                if next_page:
-                    with progress_lock:
-                        pbar.update(1)
-
         if all_products:
-            df = pd.concat(all_products, ignore_index=True)
+            df = pd.DataFrame(all_products)
             df["category"] = category
             return df
 
     except Exception as e:
-        with progress_lock:
-            print(f"Error fetching products for {category}: {str(e)}")
+        print(f"Error fetching products for {category}: {str(e)}")
 
     return pd.DataFrame()
 
 
 CONSUMER_CHANNEL_ID = "d9a5bc42-4b9c-4976-858a-f159cf99c647"
+API_URL_TEMPLATE = (
+    "https://api.nike.com/discover/product_wall/v1"
+    "/marketplace/IN/language/en-GB/consumerChannelId/{consumer_channel_id}"
+    "?path={path}&attributeIds={concept_ids}&queryType=PRODUCTS"
+    "&anchor={anchor}&count={count}"
+)
 
+# Maximum allowed products per API page
+PAGE_SIZE = 100
 
-def construct_api_url(concept_ids, path):
-    """Construct Nike API URL with concept IDs"""
-    base_url = "https://api.nike.com/discover/product_wall/v1"
-    params = {"marketplace": "IN", "language": "en-GB", "count": 100, "anchor": 0}
 
-    url = (
-        f"{base_url}/marketplace/{params['marketplace']}/language/{params['language']}"
+def construct_api_url(concept_ids, path, anchor=0):
+    """Construct Nike API URL with concept IDs"""
+    return API_URL_TEMPLATE.format(
+        consumer_channel_id=CONSUMER_CHANNEL_ID,
+        path=path,
+        concept_ids=concept_ids,
+        anchor=anchor,
+        count=PAGE_SIZE,
     )
-    url += f"/consumerChannelId/{CONSUMER_CHANNEL_ID}"
-    url += f"?path={path}"
-    url += f"&attributeIds={concept_ids}"
-    url += f"&queryType=PRODUCTS&anchor={params['anchor']}&count={params['count']}"
-
-    return url
 
 
 def extract_path_from_url(url):
@@ -320,51 +449,71 @@ def extract_path_from_url(url):
     return parsed.path.lstrip("/")
 
 
-def process_single_url(url):
-    """Process a single URL with its own session"""
-    # session = requests.Session()
-    session = curl_cffi_requests.Session()
+async def process_single_url(session, rate_limiter, url):
+    """Process a single URL using the shared session"""
     category = " ".join(url.split("/")[-1].split("-")[:-1])
 
     # Get concept IDs
-    concept_ids = extract_concept_ids(session, url)
+    concept_ids = await extract_concept_ids(session, url)
     if not concept_ids:
         return pd.DataFrame()
 
     # Extract path from URL
     path = extract_path_from_url(url)
 
-    # Construct API URL
-    api_url = construct_api_url(concept_ids, path)
-
     # Fetch products
-    return fetch_nike_products(session, api_url, category)
+    return await fetch_nike_products(
+        session, rate_limiter, concept_ids, path, category
+    )
+
+
+async def crawl():
+    """Process all category URLs concurrently over one shared session"""
+    all_data = []
+
+    # Shared across all categories so a 429 on one slows down every request;
+    # created here so its lock belongs to the running event loop
+    rate_limiter = AdaptiveLimiter(base_delay=0.0)
+
+    async with curl_cffi_requests.AsyncSession() as session:
+        # Create main progress bar for overall progress
+        with tqdm(
+            total=len(URLS), desc="Processing categories", position=1
+        ) as main_pbar:
+            task_to_url = {
+                asyncio.create_task(
+                    process_single_url(session, rate_limiter, url)
+                ): url
+                for url in URLS
+            }
+
+            pending = set(task_to_url)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    url = task_to_url[task]
+                    try:
+                        df = task.result()
+                        if not df.empty:
+                            all_data.append(df)
+                    except Exception as e:
+                        logging.error(f"Error processing {url}: {str(e)}")
+                    finally:
+                        main_pbar.update(1)
+
+    return all_data
 
 
 """Main function to run the crawler and update database"""
 # Initialize database
 init_db()
 
-all_data = []
 start_time = datetime.now()
 logging.info(f"Starting crawler run at {start_time}")
 
-# Create main progress bar for overall progress
-with tqdm(total=len(URLS), desc="Processing categories", position=1) as main_pbar:
-    with ThreadPoolExecutor(max_workers=16) as executor:
-        future_to_url = {executor.submit(process_single_url, url): url for url in URLS}
-
-        for future in as_completed(future_to_url):
-            url = future_to_url[future]
-            try:
-                df = future.result()
-                if not df.empty:
-                    all_data.append(df)
-            except Exception as e:
-                logging.error(f"Error processing {url}: {str(e)}")
-            finally:
-                with progress_lock:
-                    main_pbar.update(1)
+all_data = asyncio.run(crawl())
 
 # Combine all data and update database
 if all_data:
@@ -1,5 +1,8 @@
+import logging
+import os
 import sqlite3
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import streamlit as st
@@ -7,46 +10,191 @@ import streamlit as st
 # Database configuration
 DB_PATH = "nike_tracker.db"
 
+# Parquet snapshot of the loaded products; bump the version whenever
+# query_products changes what it returns so old snapshots are ignored
+PRODUCTS_SNAPSHOT_VERSION = 3
+PRODUCTS_SNAPSHOT_PATH = f"products.v{PRODUCTS_SNAPSHOT_VERSION}.parquet"
+PRODUCTS_SNAPSHOT_COLUMNS = [
+    "product_code",
+    "title",
+    "subtitle",
+    "category",
+    "image_url",
+    "url",
+    "current_price",
+    "last_updated",
+    "_title_lc",
+    "_code_lc",
+    "_title_sort",
+]
+
+# Timezone the crawler's timestamps are displayed in
+DISPLAY_TIMEZONE = "Asia/Kolkata"
+
+# Unix seconds for a price_history row; rows written by older crawler runs hold
+# text until the next crawl migrates them. Like extract_nike_data's migration,
+# that text is read as IST (UTC+05:30), so it displays unchanged
+TIMESTAMP_SECONDS_SQL = """
+    CASE WHEN typeof(timestamp) = 'text'
+        THEN CAST(strftime('%s', timestamp, '-330 minutes') AS INTEGER)
+        ELSE timestamp
+    END
+"""
+
 # Page configuration
 st.set_page_config(page_title="Nike Price Tracker", page_icon="👟", layout="wide")
 
 
-@st.cache_data
-def load_all_data():
-    """Load all data from database into memory"""
+def reduce_memory(df, max_unique_ratio=0.5):
+    """Downcast numeric columns and dictionary-encode repeated strings"""
+    for column in df.columns:
+        kind = df[column].dtype.kind
+        if kind == "i":
+            df[column] = pd.to_numeric(df[column], downcast="integer")
+        elif kind == "f":
+            df[column] = pd.to_numeric(df[column], downcast="float")
+        elif kind == "O" and df[column].nunique() <= max_unique_ratio * len(df):
+            df[column] = df[column].astype("category")
+    return df
+
+
+def to_display_datetime(seconds):
+    """Convert unix seconds to naive datetimes in the display timezone"""
+    return (
+        pd.to_datetime(seconds, unit="s", utc=True)
+        .dt.tz_convert(DISPLAY_TIMEZONE)
+        .dt.tz_localize(None)
+    )
+
+
+def query_products():
+    """Query products and their latest prices from database"""
     conn = sqlite3.connect(DB_PATH)
 
     # Load products
     products_df = pd.read_sql_query("SELECT * FROM products", conn)
 
-    # Load price history
-    price_history_df = pd.read_sql_query("SELECT * FROM price_history", conn)
+    # Load only the latest price for each product
+    latest_prices = pd.read_sql_query(
+        """
+        SELECT product_code, price AS current_price, timestamp AS last_updated
+        FROM (
+            SELECT
+                product_code,
+                price,
+                timestamp,
+                ROW_NUMBER() OVER (
+                    PARTITION BY product_code ORDER BY timestamp DESC, id DESC
+                ) AS row_number
+            FROM (
+                SELECT id, product_code, price, {TIMESTAMP_SECONDS_SQL} AS timestamp
+                FROM price_history
+            )
+        )
+        WHERE row_number = 1
+        """.format(TIMESTAMP_SECONDS_SQL=TIMESTAMP_SECONDS_SQL),
+        conn,
+    )
 
     conn.close()
 
-    # Calculate latest prices for each product
-    latest_prices = (
-        price_history_df.sort_values("timestamp")
-        .groupby("product_code")
-        .last()
-        .reset_index()[["product_code", "price", "timestamp"]]
-        .rename(columns={"price": "current_price", "timestamp": "last_updated"})
-    )
+    # Dictionary-encode repeated strings and parse timestamps once
+    products_df["category"] = products_df["category"].astype("category")
+    latest_prices["last_updated"] = to_display_datetime(latest_prices["last_updated"])
+
+    # Lowercase search columns once instead of on every filter call
+    products_df["_title_lc"] = products_df["title"].str.lower()
+    products_df["_code_lc"] = products_df["product_code"].str.lower()
+
+    # Rank titles once so name sorts are numeric argsorts; missing titles keep
+    # a NaN rank so sort_order places them last in both directions
+    has_title = products_df["_title_lc"].notna().to_numpy()
+    titled_positions = np.flatnonzero(has_title)
+    title_order = titled_positions[
+        np.argsort(
+            products_df["_title_lc"].to_numpy()[titled_positions], kind="stable"
+        )
+    ]
+    title_rank = np.full(len(products_df), np.nan, dtype=np.float32)
+    title_rank[title_order] = np.arange(len(title_order))
+    products_df["_title_sort"] = title_rank
 
     # Merge products with their latest prices
     products_with_prices = products_df.merge(
         latest_prices, on="product_code", how="left"
     )
 
-    return {"products": products_with_prices, "price_history": price_history_df}
+    # Ensure price is numeric
+    products_with_prices["current_price"] = pd.to_numeric(
+        products_with_prices["current_price"], errors="coerce"
+    )
+
+    return reduce_memory(products_with_prices)
+
+
+def db_mtime():
+    """Last modification time of the database, including its WAL file"""
+    wal_path = f"{DB_PATH}-wal"
+    mtimes = [os.path.getmtime(DB_PATH)]
+    if os.path.exists(wal_path):
+        mtimes.append(os.path.getmtime(wal_path))
+    return max(mtimes)
+
+
+def read_products_snapshot():
+    """Read the Parquet snapshot if it is newer than the database and complete"""
+    if (
+        not os.path.exists(PRODUCTS_SNAPSHOT_PATH)
+        or os.path.getmtime(PRODUCTS_SNAPSHOT_PATH) < db_mtime()
+    ):
+        return None
+
+    try:
+        products_df = pd.read_parquet(PRODUCTS_SNAPSHOT_PATH)
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable products snapshot: {str(e)}")
+        return None
+
+    missing = set(PRODUCTS_SNAPSHOT_COLUMNS) - set(products_df.columns)
+    if missing:
+        logging.warning(f"Ignoring products snapshot missing columns: {missing}")
+        return None
+    return products_df
+
+
+@st.cache_data
+def load_all_data():
+    """Load products into memory, from the Parquet snapshot when it is current"""
+    products_df = read_products_snapshot()
+    if products_df is not None:
+        return {"products": products_df}
+
+    products_df = query_products()
+    try:
+        products_df.to_parquet(PRODUCTS_SNAPSHOT_PATH, compression="zstd")
+    except Exception as e:
+        logging.warning(f"Could not write products snapshot: {str(e)}")
+    return {"products": products_df}
 
 
 @st.cache_data
-def get_price_history(_price_history_df, product_code):
-    """Get price history for a specific product from memory"""
-    return _price_history_df[
-        _price_history_df["product_code"] == product_code
-    ].sort_values("timestamp")
+def get_price_history(product_code):
+    """Get price history for a specific product from database"""
+    conn = sqlite3.connect(DB_PATH)
+    price_history = pd.read_sql_query(
+        """
+        SELECT price, {TIMESTAMP_SECONDS_SQL} AS timestamp
+        FROM price_history
+        WHERE product_code = ?
+        ORDER BY timestamp
+        """.format(TIMESTAMP_SECONDS_SQL=TIMESTAMP_SECONDS_SQL),
+        conn,
+        params=(product_code,),
+    )
+    conn.close()
+
+    price_history["timestamp"] = to_display_datetime(price_history["timestamp"])
+    return reduce_memory(price_history)
 
 
 @st.cache_data
@@ -61,12 +209,12 @@ def get_price_stats(price_history):
 
 
 @st.dialog("Price History", width="large")
-def show_price_history(product, _price_history_df):
+def show_price_history(product):
     """Dialog to show price history graph"""
-    st.subheader(f"Price History - {product['title']}")
+    st.subheader(f"Price History - {product.title}")
 
     # Get price history
-    price_history = get_price_history(_price_history_df, product["product_code"])
+    price_history = get_price_history(product.product_code)
     stats = get_price_stats(price_history)
 
     # Show price statistics
@@ -87,47 +235,51 @@ def show_price_history(product, _price_history_df):
         st.write("No price history available")
 
 
+def sort_order(values, ascending=True):
+    """Stable argsort that keeps missing values last in either direction"""
+    order = np.argsort(values, kind="stable")
+    if ascending:
+        return order
+    present = len(order) - pd.isna(values).sum()
+    return np.concatenate([order[:present][::-1], order[present:]])
+
+
 @st.cache_data
 def filter_products(
     _products_df, search_query=None, category=None, sort_by=None, limit=100
 ):
     """Filter products from memory"""
-    df = _products_df.copy()
+    df = _products_df
 
     # Apply filters
     if search_query:
         search_query = search_query.lower()
         df = df[
-            df["title"].str.lower().str.contains(search_query)
-            | df["product_code"].str.lower().str.contains(search_query)
+            df["_title_lc"].str.contains(search_query, regex=False, na=False)
+            | df["_code_lc"].str.contains(search_query, regex=False, na=False)
         ]
 
     if category and category != "All":
         df = df[df["category"] == category]
 
-    # Ensure price is numeric
-    df["current_price"] = pd.to_numeric(df["current_price"], errors="coerce")
-
     # Apply sorting
     if sort_by == "Price: High to Low":
-        df = df.sort_values("current_price", ascending=False)
+        order = sort_order(df["current_price"].to_numpy(), ascending=False)
     elif sort_by == "Price: Low to High":
-        df = df.sort_values("current_price", ascending=True)
+        order = sort_order(df["current_price"].to_numpy(), ascending=True)
     elif sort_by == "Name: A-Z":
-        df = df.sort_values("title", ascending=True)
+        order = sort_order(df["_title_sort"].to_numpy(), ascending=True)
     elif sort_by == "Name: Z-A":
-        df = df.sort_values("title", ascending=False)
+        order = sort_order(df["_title_sort"].to_numpy(), ascending=False)
     else:  # Recently Updated
-        df = df.sort_values("last_updated", ascending=False)
-    df.reset_index(inplace=True)
-    return df.head(limit)
+        order = sort_order(df["last_updated"].to_numpy(), ascending=False)
+    return df.take(order[:limit]).reset_index()
 
 
 def main():
     # Load all data into memory at startup
     data = load_all_data()
     products_df = data["products"]
-    price_history_df = data["price_history"]
 
     st.header("Nike Price Tracker 👟")
 
@@ -164,32 +316,34 @@ def main():
 
     # Display products in grid
     cols = st.columns(grid_size)
-    for idx, row in filtered_products.iterrows():
+    for row in filtered_products.itertuples(index=True):
+        idx = row.Index
+
         # Skip products without images
-        if pd.isna(row["image_url"]) or not row["image_url"]:
+        if pd.isna(row.image_url) or not row.image_url:
             continue
 
         col = cols[idx % grid_size]
         with col:
             st.image(
-                row["image_url"],
+                row.image_url,
                 use_container_width=True,
-                caption=f"₹{row['current_price']:,.2f}",
+                caption=f"₹{row.current_price:,.2f}",
             )
 
             # Product title with link
-            st.page_link(row["url"], label=f'**{row["title"]}**', icon="🔗")
+            st.page_link(row.url, label=f"**{row.title}**", icon="🔗")
 
             # subtitle and chart emoji in the same line
             subtitle_col, chart_col = st.columns([4, 1])
             with subtitle_col:
-                st.write(f'`{row["subtitle"]}`')
+                st.write(f"`{row.subtitle}`")
             with chart_col:
                 if st.button(
                     "📈",
                     key=f"chart_{idx}",
                 ):
-                    show_price_history(row, price_history_df)
+                    show_price_history(row)
 
 
 if __name__ == "__main__":